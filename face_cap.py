@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import contextlib
+import signal
 import sys
 import logging
 from time import sleep
@@ -29,14 +30,73 @@ IMAGE_FOLDER = "./captures"
 
 SLEEP_SECONDS = 600
 
+DETECT_EVERY_N_FRAMES = 4
 
-def run_inference():
-    """Yields (faces, (frame_width, frame_height)) tuples."""
+
+def serialized_tensors(result):
+    """Returns the raw output tensors of an inference result as bytes."""
+    return b''.join(result.tensors[name].SerializeToString()
+                    for name in sorted(result.tensors))
+
+
+def run_inference(announce=True):
+    """Yields (faces, (frame_width, frame_height)) tuples.
+
+    Faces are only decoded every DETECT_EVERY_N_FRAMES frames; the frames in
+    between repeat the last decoded faces, which are never older than that.
+    Results whose serialized tensors are identical to the last decoded ones
+    are not decoded again.
+    """
+    faces = []
+    last_tensors = None
     with CameraInference(face_detection.model()) as inference:
         print('Model loaded')
-        TonePlayer(gpio=BUZZER_GPIO, bpm=10).play(*MODEL_LOAD_SOUND)
-        for result in inference.run():
-            yield face_detection.get_faces(result), (result.width, result.height)
+        if announce:
+            TonePlayer(gpio=BUZZER_GPIO, bpm=10).play(*MODEL_LOAD_SOUND)
+        for i, result in enumerate(inference.run()):
+            if i % DETECT_EVERY_N_FRAMES == 0:
+                tensors = serialized_tensors(result)
+                if tensors != last_tensors:
+                    faces = face_detection.get_faces(result)
+                    last_tensors = tensors
+            yield faces, (result.width, result.height)
+
+
+def wait_for_faces(announce=True):
+    """Runs face detection until faces are found.
+
+    Returns (faces, (frame_width, frame_height)). The inference session is
+    closed before returning, so the VisionBonnet stays idle until the next
+    call.
+    """
+    with contextlib.closing(run_inference(announce)) as results:
+        for faces, frame_size in results:
+            if faces:
+                return faces, frame_size
+
+
+class _WakeUp(Exception):
+    pass
+
+
+def _raise_wake_up(signum, frame):
+    raise _WakeUp()
+
+
+def pause(seconds):
+    """Sleeps for the given number of seconds, or until SIGUSR1 arrives.
+
+    SIGUSR1 is ignored outside the pause, so a signal received while
+    detecting faces does not cut the next pause short.
+    """
+    try:
+        signal.signal(signal.SIGUSR1, _raise_wake_up)
+        try:
+            sleep(seconds)
+        finally:
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    except _WakeUp:
+        pass
 
 
 def capture_loop():
@@ -49,14 +109,19 @@ def capture_loop():
         server = StreamingServer(camera)  # http://raspberrypi.local:4664/
         print("server running...")
 
-        for faces, frame_size in run_inference():
-            if faces:
-                player.play(BEEP_SOUND)
-                photographer.update_faces((faces, frame_size))
-                photographer.shoot(camera)
-                print(faces)
-                print(frame_size)
-                sleep(SLEEP_SECONDS)
+        # SIGUSR1 ends the pause between shots early.
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+        announce = True
+        while True:
+            faces, frame_size = wait_for_faces(announce)
+            announce = False
+            player.play(BEEP_SOUND)
+            photographer.update_faces((faces, frame_size))
+            photographer.shoot(camera)
+            print(faces)
+            print(frame_size)
+            pause(SLEEP_SECONDS)
 
 
 def main():
@@ -1,5 +1,8 @@
 #!/bin/bash
 
+apt-get install -y python3-pip libturbojpeg0
+pip3 install -r requirements.txt
+
 cp face_cap.service /lib/systemd/system/face_cap.service
 systemctl daemon-reload
 systemctl enable face_cap.service
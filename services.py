@@ -1,3 +1,4 @@
+import collections
 import contextlib
 import io
 import logging
@@ -5,8 +6,12 @@ import os
 import queue
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
+import numba
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
+from turbojpeg import TJPF_RGB, TJSAMP_420, TurboJPEG
 
 from aiy.leds import Color, Leds
 from aiy.toneplayer import TonePlayer
@@ -28,53 +33,142 @@ FONT_FILE = '/usr/share/fonts/truetype/freefont/FreeSans.ttf'
 
 BUZZER_GPIO = 22
 
+DROP_LOG_INTERVAL_SECONDS = 10
 
-@contextlib.contextmanager
-def stopwatch(message):
-    try:
-        logger.info('%s...', message)
-        begin = time.monotonic()
-        yield
-    finally:
-        end = time.monotonic()
-        logger.info('%s done. (%fs)', message, end - begin)
-
+SERVICE_WORKERS = 2
 
-def draw_rectangle(draw, x0, y0, x1, y1, border, fill=None, outline=None):
-    assert border % 2 == 1
-    for i in range(-border // 2, border // 2 + 1):
-        draw.rectangle((x0 + i, y0 + i, x1 - i, y1 - i), fill=fill, outline=outline)
+WHITE = np.array([255, 255, 255], dtype=np.uint8)
+BLACK = np.array([0, 0, 0], dtype=np.uint8)
+BORDER = 3
 
+# Number of frames shot per capture; the sharpest one is kept.
+BURST_SIZE = 5
 
-def scale_bounding_box(bounding_box, scale_x, scale_y):
-    x, y, w, h = bounding_box
-    return (x * scale_x, y * scale_y, w * scale_x, h * scale_y)
+# JPEGs are encoded with 4:2:0 chroma subsampling, so lossless crops must
+# start on a 16 pixel MCU boundary.
+JPEG_MCU_SIZE = 16
 
 
-def bounding_extent_to_corners(bounding_box, image_size):
-    x, y, width, height = bounding_box
-    left = x
-    upper = y
-    right = x + width
-    lower = y + height
-    return left, upper, right, lower
+@contextlib.contextmanager
+def stopwatch(message, *args):
+    if not logger.isEnabledFor(logging.INFO):
+        yield
+        return
+    message = message % args
+    try:
+        logger.info('%s...', message)
+        begin = time.perf_counter_ns()
+        yield
+    finally:
+        end = time.perf_counter_ns()
+        logger.info('%s done. (%.3fms)', message, (end - begin) / 1e6)
+
+
+@numba.njit(cache=True, fastmath=True)
+def scale_and_corners(boxes, scale_x, scale_y):
+    """Scales (N, 4) x, y, width, height boxes into left, upper, right, lower corners."""
+    out = np.empty_like(boxes)
+    out[:, 0] = boxes[:, 0] * scale_x
+    out[:, 1] = boxes[:, 1] * scale_y
+    out[:, 2] = (boxes[:, 0] + boxes[:, 2]) * scale_x
+    out[:, 3] = (boxes[:, 1] + boxes[:, 3]) * scale_y
+    return out
+
+
+def sharpness(pixels):
+    """Variance of the Laplacian of a decimated green channel; higher is sharper."""
+    luma = pixels[::4, ::4, 1].astype(np.float32)
+    laplacian = (luma[1:-1, :-2] + luma[1:-1, 2:] + luma[:-2, 1:-1] + luma[2:, 1:-1]
+                 - 4 * luma[1:-1, 1:-1])
+    return laplacian.var()
+
+
+def fill_rect(pixels, x0, y0, x1, y1, color):
+    """Fills pixels[y0:y1, x0:x1] with color, clipped to the image."""
+    height, width = pixels.shape[:2]
+    x0, x1 = max(x0, 0), min(x1, width)
+    y0, y1 = max(y0, 0), min(y1, height)
+    if x0 < x1 and y0 < y1:
+        pixels[y0:y1, x0:x1] = color
+
+
+def blit_mask(pixels, x, y, mask, color):
+    """Sets pixels under the boolean mask placed at (x, y) to color."""
+    height, width = pixels.shape[:2]
+    mask_height, mask_width = mask.shape
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + mask_width, width), min(y + mask_height, height)
+    if x0 < x1 and y0 < y1:
+        pixels[y0:y1, x0:x1][mask[y0 - y:y1 - y, x0 - x:x1 - x]] = color
+
+
+_executor = None
+_executor_users = 0
+_executor_lock = threading.Lock()
+
+
+def _acquire_executor():
+    """Returns the process-wide service pool, creating it on first use."""
+    global _executor, _executor_users
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=SERVICE_WORKERS,
+                                           thread_name_prefix='aiy-svc')
+        _executor_users += 1
+        return _executor
+
+
+def _release_executor():
+    """Shuts the service pool down once its last user has closed."""
+    global _executor, _executor_users
+    with _executor_lock:
+        _executor_users -= 1
+        if _executor_users == 0:
+            _executor.shutdown(wait=True)
+            _executor = None
 
 
 class Service:
-
-    def __init__(self):
-        self._requests = queue.Queue()
-        self._thread = threading.Thread(target=self._run, daemon=True)
-        self._thread.start()
-
-    def _run(self):
+    """Processes requests in order on a shared thread pool.
+
+    A service only occupies a pool thread while it has pending requests.
+    Pending requests are kept in a ring buffer of at most `maxsize` entries;
+    when it is full the oldest request is dropped in favour of the newest.
+    close() processes whatever is still pending before shutting down.
+    """
+
+    def __init__(self, maxsize=None):
+        self._requests = collections.deque(maxlen=maxsize)
+        self._lock = threading.Lock()
+        self._draining = False
+        self._closing = False
+        self._closed = threading.Event()
+        self._dropped = 0
+        self._last_drop_log = 0.0
+        # The shared pool is only acquired on first use, so a subclass whose
+        # constructor fails never holds a reference to it.
+        self._executor = None
+
+    def _drain(self):
         while True:
-            request = self._requests.get()
-            if request is None:
-                self.shutdown()
-                break
-            self.process(request)
-            self._requests.task_done()
+            with self._lock:
+                if self._requests:
+                    request = self._requests.popleft()
+                elif self._closing:
+                    break
+                else:
+                    self._draining = False
+                    return
+            try:
+                self.process(request)
+            except Exception:
+                logger.exception('%s failed to process request.', type(self).__name__)
+        try:
+            self.shutdown()
+        except Exception:
+            logger.exception('%s failed to shut down.', type(self).__name__)
+        finally:
+            self._closed.set()
 
     def process(self, request):
         pass
@@ -83,11 +177,42 @@ class Service:
         pass
 
     def submit(self, request):
-        self._requests.put(request)
+        with self._lock:
+            if len(self._requests) == self._requests.maxlen:
+                self._log_drop()
+            self._requests.append(request)
+        self._schedule()
+
+    def _schedule(self):
+        """Starts a drain task unless one is already running."""
+        with self._lock:
+            schedule = not self._draining
+            self._draining = True
+            if schedule and self._executor is None:
+                self._executor = _acquire_executor()
+        if schedule:
+            self._executor.submit(self._drain)
+
+    def _log_drop(self):
+        self._dropped += 1
+        now = time.monotonic()
+        if now - self._last_drop_log >= DROP_LOG_INTERVAL_SECONDS:
+            logger.warning('%s is behind, dropped %d request(s) so far.',
+                           type(self).__name__, self._dropped)
+            self._last_drop_log = now
 
     def close(self):
-        self._requests.put(None)
-        self._thread.join()
+        # Closing is a flag rather than a queued marker so that it never
+        # pushes pending requests out of a full ring buffer.
+        with self._lock:
+            closing = self._closing
+            self._closing = True
+        if closing:
+            self._closed.wait()
+            return
+        self._schedule()
+        self._closed.wait()
+        _release_executor()
 
     def __enter__(self):
         return self
@@ -100,7 +225,7 @@ class Player(Service):
     """Controls buzzer."""
 
     def __init__(self, gpio, bpm):
-        super().__init__()
+        super().__init__(maxsize=8)
         self._toneplayer = TonePlayer(gpio, bpm)
 
     def process(self, sound):
@@ -110,34 +235,142 @@ class Player(Service):
         self.submit(sound)
 
 
+class _BufferOutput:
+    """File-like camera output that writes into a preallocated buffer."""
+
+    def __init__(self, buffer):
+        self._view = memoryview(buffer)
+        self.size = 0
+
+    def reset(self):
+        self.size = 0
+
+    def write(self, data):
+        n = len(data)
+        self._view[self.size:self.size + n] = data
+        self.size += n
+        return n
+
+    def flush(self):
+        pass
+
+
 class Photographer(Service):
     """Saves photographs to disk."""
 
-    def __init__(self, format, folder):
-        super().__init__()
+    def __init__(self, format, folder, annotate=False, quality=85):
+        super().__init__(maxsize=2)
         assert format in ('jpeg', 'bmp', 'png')
 
-        self._font = ImageFont.truetype(FONT_FILE, size=25)
+        self._label_cache = {}
         self._faces = ([], (0, 0))
         self._format = format
         self._folder = folder
+        self._annotate = annotate
+        if annotate:
+            self._font = ImageFont.truetype(FONT_FILE, size=25)
+            _, self._text_height = self._font.getsize('Joy: 0.00')
+        self._quality = quality
+        self._tj = TurboJPEG()
+        self._raw = []
+        self._raw_outs = []
+        self._io_q = queue.Queue(maxsize=4)
+        self._io_thread = threading.Thread(target=self._io_loop, daemon=True)
+        self._io_thread.start()
+        self._warm_up()
         #if not os.path.exists(os.path.expanduser(self._folder)):
         #    os.mkdir(os.path.expanduser(self._folder))
 
+    def _warm_up(self):
+        """Pays one-time font and JIT costs before the first face shows up."""
+        if self._annotate:
+            for i in range(21):
+                self._label('Joy: %.2f' % (i * 0.05))
+        scale_and_corners(np.zeros((1, 4), dtype=np.float32), 1.0, 1.0)
+
     def _make_filename(self, timestamp, suffix=""):
-        path = '%s/%s_%s.%s' if len(suffix) > 0 else '%s/%s%s.%s'
-        return os.path.expanduser(path % (self._folder, timestamp, suffix, self._format))
+        name = f'{timestamp}_{suffix}' if suffix else timestamp
+        return os.path.expanduser(f'{self._folder}/{name}.{self._format}')
 
-    def _draw_face(self, draw, face, scale_x, scale_y):
-        x, y, width, height = scale_bounding_box(face.bounding_box, scale_x, scale_y)
+    def _io_loop(self):
+        while True:
+            item = self._io_q.get()
+            if item is None:
+                break
+            filename, data = item
+            try:
+                with stopwatch('Writing %s', filename):
+                    with open(filename, 'wb') as file:
+                        file.write(data)
+                        if hasattr(os, 'posix_fadvise'):
+                            # Dirty pages can't be dropped, so sync them first.
+                            file.flush()
+                            os.fdatasync(file.fileno())
+                            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            except Exception:
+                logger.exception('Failed to write %s.', filename)
+            finally:
+                self._io_q.task_done()
+
+    def _write(self, filename, data):
+        """Hands encoded bytes to the writer thread; blocks while it is behind."""
+        self._io_q.put((filename, data))
+
+    def _encode(self, pixels):
+        """Encodes an HxWx3 RGB array into bytes of the configured format."""
+        if self._format == 'jpeg':
+            return self._tj.encode(pixels, quality=self._quality, pixel_format=TJPF_RGB,
+                                   jpeg_subsample=TJSAMP_420)
+        stream = io.BytesIO()
+        Image.fromarray(pixels).save(stream, format=self._format)
+        return stream.getvalue()
+
+    def _encode_crop(self, original, pixels, corners):
+        """Returns the encoded crop of pixels within corners, or None if empty.
+
+        JPEG crops are cut losslessly out of the already encoded original, so
+        the region grows up and left to the nearest MCU boundary.
+        """
+        height, width = pixels.shape[:2]
+        left, upper, right, lower = corners
+        left, upper = max(left, 0), max(upper, 0)
+        right, lower = min(right, width), min(lower, height)
+        if right <= left or lower <= upper:
+            return None
+        if self._format != 'jpeg':
+            return self._encode(pixels[upper:lower, left:right])
+        left -= left % JPEG_MCU_SIZE
+        upper -= upper % JPEG_MCU_SIZE
+        return self._tj.crop(original, left, upper, right - left, lower - upper)
+
+    def _save_crop(self, filename, original, pixels, corners):
+        with stopwatch('Saving cropped %s', filename):
+            data = self._encode_crop(original, pixels, corners)
+            if data is None:
+                logger.warning('Skipping %s, face box %s is outside the frame.', filename, corners)
+                return
+            self._write(filename, data)
+
+    def _label(self, text):
+        """Returns a cached boolean mask with the rendered text."""
+        mask = self._label_cache.get(text)
+        if mask is None:
+            tile = Image.new('L', self._font.getsize(text), 0)
+            ImageDraw.Draw(tile).text((0, 0), text, font=self._font, fill=255)
+            mask = np.asarray(tile) > 127
+            self._label_cache[text] = mask
+        return mask
+
+    def _draw_face(self, pixels, face, corners):
+        x, y, right, bottom = corners
         text = 'Joy: %.2f' % face.joy_score
-        _, text_height = self._font.getsize(text)
         margin = 3
-        bottom = y + height
-        text_bottom = bottom + margin + text_height + margin
-        draw_rectangle(draw, x, y, x + width, bottom, 3, outline='white')
-        draw_rectangle(draw, x, bottom, x + width, text_bottom, 3, fill='white', outline='white')
-        draw.text((x + 1 + margin, y + height + 1 + margin), text, font=self._font, fill='black')
+        text_bottom = bottom + margin + self._text_height + margin
+        fill_rect(pixels, x, y, right, y + BORDER, WHITE)
+        fill_rect(pixels, x, y, x + BORDER, bottom, WHITE)
+        fill_rect(pixels, right - BORDER, y, right, bottom, WHITE)
+        fill_rect(pixels, x, bottom - BORDER, right, text_bottom, WHITE)
+        blit_mask(pixels, x + 1 + margin, bottom + 1 + margin, self._label(text), BLACK)
 
     def process(self, message):
         if isinstance(message, tuple):
@@ -147,33 +380,50 @@ class Photographer(Service):
         camera = message
         timestamp = time.strftime('%Y-%m-%d_%H.%M.%S')
 
-        stream = io.BytesIO()
-        with stopwatch('Taking photo'):
-            camera.capture(stream, format=self._format, use_video_port=True)
+        # Raw captures are padded to a multiple of 32 columns and 16 rows.
+        cam_width, cam_height = camera.resolution
+        raw_width, raw_height = (cam_width + 31) // 32 * 32, (cam_height + 15) // 16 * 16
+        if not self._raw or len(self._raw[0]) != raw_width * raw_height * 3:
+            self._raw = [bytearray(raw_width * raw_height * 3) for _ in range(BURST_SIZE)]
+            self._raw_outs = [_BufferOutput(raw) for raw in self._raw]
+        for out in self._raw_outs:
+            out.reset()
+        with stopwatch('Taking %d photos', BURST_SIZE):
+            camera.capture_sequence(self._raw_outs, format='rgb', use_video_port=True)
+        frames = [np.frombuffer(raw, dtype=np.uint8).reshape(raw_height, raw_width, 3)
+                  [:cam_height, :cam_width] for raw in self._raw]
+        pixels = max(frames, key=sharpness)
 
         filename = self._make_filename(timestamp)
-        with stopwatch('Saving original %s' % filename):
-            stream.seek(0)
-            with open(filename, 'wb') as file:
-                file.write(stream.read())
+        with stopwatch('Encoding original %s', filename):
+            original = self._encode(pixels)
+            self._write(filename, original)
 
         faces, (width, height) = self._faces
         if faces:
-            filename1 = self._make_filename(timestamp, "annotated")
-            filename2 = self._make_filename(timestamp, "cropped")
-            with stopwatch('Saving annotated %s' % filename):
-                stream.seek(0)
-                image = Image.open(stream)
-                draw = ImageDraw.Draw(image)
-                scale_x, scale_y = image.width / width, image.height / height
-                i = 0
-                for face in faces:
-                    scaled = scale_bounding_box(face.bounding_box, scale_x, scale_y)
-                    corners = bounding_extent_to_corners(scaled, image.size)
-                    image2 = image.crop(corners)
-                    self._draw_face(draw, face, scale_x, scale_y)
-                    image2.save(filename2 + str(i))
-                del draw
+            scale_x, scale_y = cam_width / width, cam_height / height
+            boxes = np.array([face.bounding_box for face in faces], dtype=np.float32)
+            corners = scale_and_corners(boxes, scale_x, scale_y).astype(np.int32).tolist()
+
+            if len(faces) == 1:
+                filename2 = self._make_filename(timestamp, "cropped")
+                self._save_crop(filename2, original, pixels, corners[0])
+            else:
+                for i, face_corners in enumerate(corners):
+                    filename2 = self._make_filename(timestamp, f"cropped_{i}")
+                    self._save_crop(filename2, original, pixels, face_corners)
+
+            if self._annotate:
+                filename1 = self._make_filename(timestamp, "annotated")
+                with stopwatch('Saving annotated %s', filename1):
+                    annotated = pixels.copy()
+                    for face, face_corners in zip(faces, corners):
+                        self._draw_face(annotated, face, face_corners)
+                    self._write(filename1, self._encode(annotated))
+
+    def shutdown(self):
+        self._io_q.put(None)
+        self._io_thread.join()
 
     def update_faces(self, faces):
         self.submit(faces)
@@ -186,17 +436,20 @@ class Animator(Service):
     """Controls RGB LEDs."""
 
     def __init__(self, leds):
-        super().__init__()
+        super().__init__(maxsize=1)
         self._leds = leds
+        self._rgb_off = Leds.rgb_off()
+        self._rgb_on = [Leds.rgb_on(Color.blend(JOY_COLOR, SAD_COLOR, i / 255))
+                        for i in range(256)]
 
     def process(self, joy_score):
         if joy_score > 0:
-            self._leds.update(Leds.rgb_on(Color.blend(JOY_COLOR, SAD_COLOR, joy_score)))
+            self._leds.update(self._rgb_on[min(255, int(joy_score * 255))])
         else:
-            self._leds.update(Leds.rgb_off())
+            self._leds.update(self._rgb_off)
 
     def shutdown(self):
-        self._leds.update(Leds.rgb_off())
+        self._leds.update(self._rgb_off)
 
     def update_joy_score(self, joy_score):
         self.submit(joy_score)